@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
 import os
+import sys
 import csv
 import threading
 import logging
 import shutil
+import queue
+import io
+from collections import deque
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
 from datetime import datetime
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from pathlib import Path
+from flask import Flask, request, jsonify, send_from_directory, abort
+from werkzeug.security import safe_join
+from urllib.parse import quote
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from openpyxl import Workbook
-from openpyxl.utils import get_column_letter
+import xlsxwriter
 
 load_dotenv()
 
@@ -17,17 +30,36 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 app = Flask(__name__, static_folder="static", template_folder="templates")
 
+# --- orjson-backed JSON for jsonify / request.json ---
+class OrjsonProvider(DefaultJSONProvider):
+    """Routes Flask's JSON encoding/decoding through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app.json = OrjsonProvider(app)
+
 # --- Middleware for /CRC Prefix ---
 class PrefixMiddleware(object):
     def __init__(self, app, prefix=''):
-        self.app = app
-        self.prefix = prefix
+        self._app = app
+        self._p = sys.intern(prefix)
+        self._pl = len(prefix)
 
     def __call__(self, environ, start_response):
-        if environ['PATH_INFO'].startswith(self.prefix):
-            environ['PATH_INFO'] = environ['PATH_INFO'][len(self.prefix):]
-            environ['SCRIPT_NAME'] = self.prefix
-            return self.app(environ, start_response)
+        p = environ['PATH_INFO']
+        pl = self._pl
+        if p[:pl] == self._p:
+            environ['PATH_INFO'] = p[pl:]
+            environ['SCRIPT_NAME'] = self._p
+            return self._app(environ, start_response)
         else:
             start_response('404', [('Content-Type', 'text/plain')])
             return [b"Not Found"]
@@ -39,65 +71,372 @@ SNIPE_URL = os.getenv("SNIPE_URL")
 SNIPE_TOKEN = os.getenv("SNIPE_API_TOKEN")
 CURRENT_CSV = os.getenv("CURRENT_CSV", "current_scan.csv")
 COMPLETED_FOLDER = os.getenv("COMPLETED_FOLDER", "completed_scans")
+CURRENT_CSV_P = Path(CURRENT_CSV)
+COMPLETED_FOLDER_P = Path(COMPLETED_FOLDER)
 CSV_HEADERS = os.getenv(
     "CSV_HEADERS", "Equipment Type,Item Description,Serial Number,Temple Tag"
 ).split(",")
 
 SNIPE_VERIFY_SSL = os.getenv("SNIPE_VERIFY_SSL", "true").lower() == "true"
 SNIPE_TIMEOUT = int(os.getenv("SNIPE_TIMEOUT_SECONDS", "5"))
+SNIPE_RETRIES = 1
+# Worst case for one Snipe-IT call: every attempt times out, plus backoff slack
+SNIPE_DEADLINE = SNIPE_TIMEOUT * (SNIPE_RETRIES + 1) + 1
+# Request threads per process (match gunicorn --threads); each /lookup fans
+# out into three Snipe-IT calls, so the lookup pool is sized 3x this.
+WEB_THREADS = int(os.getenv("WEB_THREADS", "8"))
+
+# Let the front-end web server stream downloads with sendfile(2).
+# USE_X_SENDFILE=true emits X-Sendfile (Apache mod_xsendfile, lighttpd);
+# X_ACCEL_PREFIX=/internal-url/ emits nginx X-Accel-Redirect to an `internal;`
+# location aliased to COMPLETED_FOLDER.
+app.use_x_sendfile = os.getenv("USE_X_SENDFILE", "false").lower() == "true"
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_PREFIX", "")
+
+# Snipe-IT endpoints, derived once from SNIPE_URL (which may end in /hardware)
+BASE_API = (SNIPE_URL or "").rstrip("/").removesuffix("/hardware")
+TAG_URL = f"{BASE_API}/hardware/bytag/"
+SERIAL_URL = f"{BASE_API}/hardware/byserial/"
+SEARCH_URL = f"{BASE_API}/hardware"
+SNIPE_HEADERS = {"Authorization": f"Bearer {SNIPE_TOKEN}", "Accept": "application/json"}
+
+# Shared session so lookups reuse pooled keep-alive connections to Snipe-IT
+SNIPE_SESSION = requests.Session()
+SNIPE_SESSION.headers.update(SNIPE_HEADERS)
+_snipe_adapter = HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=max(32, 3 * WEB_THREADS),
+    max_retries=Retry(total=SNIPE_RETRIES, backoff_factor=0.1),
+)
+SNIPE_SESSION.mount("https://", _snipe_adapter)
+SNIPE_SESSION.mount("http://", _snipe_adapter)
+# Runs the tag/serial/search lookups side by side. One slot per call that can
+# be in flight, so a slow Snipe-IT never leaves new lookups queued behind it.
+_SNIPE_POOL = ThreadPoolExecutor(max_workers=3 * WEB_THREADS)
+# Recent lookup results (misses included), keyed by the normalized term
+LOOKUP_CACHE = TTLCache(maxsize=4096, ttl=300)
+LOOKUP_CACHE_LOCK = threading.Lock()
+_MISSING = object()
+# lookup_snipe result when Snipe-IT could not give a definite answer
+# (timeouts, transport or server errors); never cached.
+LOOKUP_FAILED = object()
+
+# Sorted listing of COMPLETED_FOLDER, rebuilt only when the folder's mtime moves
+_FILES_CACHE = None
+_FILES_MTIME = 0
+_FILES_LOCK = threading.Lock()
+
+RECENT_COUNT = 5
 
 CSV_LOCK = threading.Lock()
-# REMOVED: SEEN_SERIALS global variable (caused the sync bug)
-
-if not os.path.exists(COMPLETED_FOLDER):
-    os.makedirs(COMPLETED_FOLDER)
+# Serials already in CURRENT_CSV. Loaded lazily from the file (the source of
+# truth) on first use, then kept in sync on every append.
+SEEN_SERIALS: set[str] = set()
+SERIALS_LOADED = False
+# Whether any field in the current batch holds a line break. Maintained with
+# SEEN_SERIALS; while False, /recent can parse a tail window safely.
+MULTILINE_FIELDS = False
+# Append-only descriptor for CURRENT_CSV, opened on first write and closed
+# whenever the file is finalized or reset.
+CSV_FD = None
+# (serial, encoded row) pairs waiting for the background writer. Rows are
+# only enqueued under CSV_LOCK, so draining while holding the lock leaves the
+# file complete.
+_WRITE_Q = queue.Queue()
+# Started on first use so each (possibly forked) process runs its own writer
+_WRITER = None
+# Sticky description of a failed background write. While set, /add, /recent
+# and /finalize refuse to work; /reset_batch or a restart clears it.
+_WRITE_ERROR = None
+# True once CURRENT_CSV is known to exist with headers; cleared by finalize
+_CSV_PRESENT = False
+
+COMPLETED_FOLDER_P.mkdir(parents=True, exist_ok=True)
 
 
 # ----- Helpers -----
+def _write_header_locked():
+    """Truncates the CSV down to just the header row. Caller holds CSV_LOCK."""
+    global _CSV_PRESENT
+    with open(CURRENT_CSV_P, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADERS)
+    _CSV_PRESENT = True
+
+
+def _ensure_csv_locked():
+    """Ensures the CSV exists with headers. Caller holds CSV_LOCK."""
+    global _CSV_PRESENT
+    if _CSV_PRESENT:
+        return
+    try:
+        _CSV_PRESENT = CURRENT_CSV_P.stat().st_size > 0
+    except FileNotFoundError:
+        pass
+    if not _CSV_PRESENT:
+        _write_header_locked()
+
+
 def ensure_csv():
     """Ensures the CSV exists with headers."""
+    if _CSV_PRESENT:
+        return
     with CSV_LOCK:
-        if not os.path.exists(CURRENT_CSV) or os.path.getsize(CURRENT_CSV) == 0:
-            with open(CURRENT_CSV, "w", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(CSV_HEADERS)
+        _ensure_csv_locked()
+
+
+def _iter_serial_fields(text):
+    """Yields (Serial Number field, spans_lines) for every data row in the CSV
+    text; spans_lines is True when a quoted field in the row holds a newline.
+
+    Unquoted rows (nearly all of them) are split directly; only rows that
+    contain a quote go through csv, joined with following lines until the
+    quotes balance so multi-line fields still parse correctly.
+    """
+    lines = iter(text.split("\n"))
+    next(lines, None) # Skip Header
+    for line in lines:
+        spans_lines = False
+        if '"' not in line:
+            fields = line.rstrip("\r").split(",", 3)
+        else:
+            # Track quote parity per piece so joining stays linear
+            pieces = [line]
+            odd = line.count('"') & 1
+            while odd:
+                nxt = next(lines, None)
+                if nxt is None:
+                    break
+                pieces.append(nxt)
+                odd ^= nxt.count('"') & 1
+            spans_lines = len(pieces) > 1
+            fields = next(csv.reader(["\n".join(pieces)]), [])
+        # Column 2 is Serial Number
+        if len(fields) > 2:
+            yield fields[2], spans_lines
+
+
+def _load_serials_locked():
+    """Populates SEEN_SERIALS with one pass over the CSV. Caller holds CSV_LOCK.
+
+    Returns an error message if the file could not be read; SERIALS_LOADED
+    then stays False so the next append retries the load.
+    """
+    global SERIALS_LOADED, MULTILINE_FIELDS
+    SEEN_SERIALS.clear()
+    try:
+        with open(CURRENT_CSV_P, "r", newline="", encoding="utf-8") as f:
+            text = f.read()
+        multiline = False
+        for s, spans_lines in _iter_serial_fields(text):
+            multiline |= spans_lines
+            s = s.strip()
+            if s:
+                SEEN_SERIALS.add(s.lower())
+        MULTILINE_FIELDS = multiline
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f"Read error while loading serials: {e}")
+        SEEN_SERIALS.clear()
+        return f"Could not check for duplicates ({e}). Scan not saved."
+    SERIALS_LOADED = True
+    return None
+
+
+def _invalidate_serials_locked():
+    """Forces the next append to reload serials. Caller holds CSV_LOCK."""
+    global SERIALS_LOADED, MULTILINE_FIELDS
+    SEEN_SERIALS.clear()
+    SERIALS_LOADED = False
+    MULTILINE_FIELDS = False
+
+
+def _csv_escape(value):
+    """Encodes one CSV field, quoting only when RFC 4180 requires it."""
+    if value is None:
+        return b"" # csv.writer writes None as an empty field
+    s = str(value)
+    if any(ch in s for ch in ',"\n\r'):
+        return b'"' + s.replace('"', '""').encode("utf-8") + b'"'
+    return s.encode("utf-8")
+
+
+def _csv_fd_locked():
+    """Returns the append descriptor, opening it if needed.
+    Caller is the writer thread, or holds CSV_LOCK with the queue drained."""
+    global CSV_FD
+    if CSV_FD is None:
+        CSV_FD = os.open(CURRENT_CSV_P, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    return CSV_FD
+
+
+def _close_csv_fd_locked():
+    """Closes the append descriptor. Caller holds CSV_LOCK."""
+    global CSV_FD
+    if CSV_FD is not None:
+        os.close(CSV_FD)
+        CSV_FD = None
+
+
+def _csv_writer_loop():
+    """Drains _WRITE_Q, appending everything queued so far in one write."""
+    global _WRITE_ERROR
+    while True:
+        batch = [_WRITE_Q.get()]
+        try:
+            while True:
+                batch.append(_WRITE_Q.get_nowait())
+        except queue.Empty:
+            pass
+        data = b"".join(line for _, line in batch)
+        written = 0
+        try:
+            fd = _csv_fd_locked()
+            start = os.fstat(fd).st_size
+            buf = memoryview(data)
+            while written < len(data):
+                written += os.write(fd, buf[written:])
+        except Exception as e:
+            # Rows that fully reached the disk stay saved; only the rest are lost
+            saved, end = 0, 0
+            for _, line in batch:
+                if end + len(line) > written:
+                    break
+                end += len(line)
+                saved += 1
+            lost = [serial for serial, _ in batch[saved:]]
+            if written > end:
+                # Drop the torn partial row so the CSV stays parseable
+                try:
+                    os.ftruncate(fd, start + end)
+                except Exception as te:
+                    logging.error(f"Could not trim partial CSV row: {te}")
+            logging.error(f"CSV write error, {len(lost)} row(s) not saved: {e}")
+            # Let the lost serials be rescanned, and stop accepting rows that
+            # would silently disappear the same way.
+            for serial in lost:
+                SEEN_SERIALS.discard(serial.lower())
+            _WRITE_ERROR = (
+                f"Saving to disk failed ({e}). {len(lost)} recent scan(s) were not "
+                f"saved: {', '.join(s for s in lost if s) or 'no serial'}. "
+                "Fix the problem and restart the scanner, then rescan them."
+            )
+        finally:
+            for _ in batch:
+                _WRITE_Q.task_done()
+
+
+def _ensure_writer_locked():
+    """Starts the writer thread if this process has none. Caller holds CSV_LOCK.
+
+    Threads do not survive fork (e.g. gunicorn --preload), so liveness is
+    checked here rather than trusting a thread started at import.
+    """
+    global _WRITER
+    if _WRITER is None or not _WRITER.is_alive():
+        _WRITER = threading.Thread(target=_csv_writer_loop, name="csv-writer", daemon=True)
+        _WRITER.start()
+
+
+def _drain_writes_locked():
+    """Blocks until every queued row is on disk and returns any sticky write
+    error. Caller holds CSV_LOCK."""
+    _ensure_writer_locked()
+    _WRITE_Q.join()
+    return _WRITE_ERROR
+
+
+def _reset_writer_after_fork():
+    # The parent's writer is gone in the child but may still be registered as
+    # a waiter on the inherited queue, swallowing wakeups; start from scratch.
+    global _WRITE_Q, _WRITER
+    _WRITE_Q = queue.Queue()
+    _WRITER = None
+
+
+os.register_at_fork(after_in_child=_reset_writer_after_fork)
+
+
+@atexit.register
+def _flush_writes_at_exit():
+    if _WRITER is not None and _WRITER.is_alive():
+        _WRITE_Q.join()
 
 
 def append_row(data):
-    ensure_csv()
+    global MULTILINE_FIELDS
     target_serial = data.get("Serial Number", "").strip()
+    key = target_serial.lower()
+
+    # Encode outside the lock; CSV_LOCK only guards the check-and-claim below
+    try:
+        row = [
+            data.get("Equipment Type", ""),
+            data.get("Item Description", ""),
+            target_serial,
+            data.get("Temple Tag", "N/A"),
+        ]
+        line = b",".join(_csv_escape(v) for v in row) + b"\r\n"
+        multiline = any(
+            "\n" in v or "\r" in v for v in row if isinstance(v, str)
+        )
+    except Exception as e:
+        return False, str(e)
 
     with CSV_LOCK:
-        # 1. READ FILE to check for duplicates (Source of Truth)
-        # This fixes the multi-worker bug because they all read the same file.
-        if target_serial:
-            try:
-                with open(CURRENT_CSV, "r", encoding="utf-8") as f:
-                    reader = csv.reader(f)
+        if _WRITE_ERROR:
+            return False, _WRITE_ERROR
+        _ensure_csv_locked()
+        # 1. Check for duplicates against the in-memory set (O(1) per scan)
+        if not SERIALS_LOADED:
+            error = _load_serials_locked()
+            if error:
+                return False, error
+        if key and key in SEEN_SERIALS:
+            return False, "Duplicate Serial detected in this batch."
+
+        # 2. QUEUE if safe; the writer thread appends it to disk
+        if key:
+            SEEN_SERIALS.add(key)
+        if multiline:
+            MULTILINE_FIELDS = True
+        _ensure_writer_locked()
+        _WRITE_Q.put((target_serial, line))
+    return True, "Saved"
+
+
+def _tail_rows(count, multiline, chunk=8192):
+    """Parses only the last `count` data rows of the CSV by reading from the end.
+
+    The window is cut at the first b"\n" so csv sees whole records. Without
+    multi-line fields every b"\n" ends a record, so that cut is always safe.
+    If the batch has them (`multiline`) and the window holds a quote, it may
+    start inside a field, so the CSV is parsed from the beginning instead.
+    """
+    with open(CURRENT_CSV_P, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        while True:
+            start = max(0, size - chunk)
+            f.seek(start)
+            data = f.read()
+            if start:
+                nl = data.find(b"\n")
+                data = data[nl + 1:] if nl >= 0 else b""
+                if multiline and b'"' in data:
+                    f.seek(0)
+                    reader = csv.reader(
+                        io.TextIOWrapper(f, encoding="utf-8", errors="replace", newline="")
+                    )
                     next(reader, None) # Skip Header
-                    for row in reader:
-                        # Column 2 is Serial Number
-                        if len(row) > 2 and row[2].strip().lower() == target_serial.lower():
-                            return False, "Duplicate Serial detected in this batch."
-            except Exception as e:
-                logging.error(f"Read error during dupe check: {e}")
-
-        # 2. WRITE if safe
-        try:
-            row = [
-                data.get("Equipment Type", ""),
-                data.get("Item Description", ""),
-                target_serial,
-                data.get("Temple Tag", "N/A"),
-            ]
-
-            with open(CURRENT_CSV, "a", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(row)
-
-            return True, "Saved"
-        except Exception as e:
-            return False, str(e)
+                    return list(deque(reader, maxlen=count))
+            rows = list(csv.reader(io.StringIO(data.decode("utf-8", "replace"), newline="")))
+            if start == 0:
+                rows = rows[1:] # Skip Header
+            if start == 0 or len(rows) >= count:
+                return rows[-count:]
+            chunk *= 2
 
 
 def lookup_snipe(term):
@@ -106,36 +445,61 @@ def lookup_snipe(term):
     if not term:
         return None
 
-    base_api = SNIPE_URL.rstrip("/")
-    if base_api.endswith("/hardware"):
-        base_api = base_api.replace("/hardware", "")
-
-    headers = {"Authorization": f"Bearer {SNIPE_TOKEN}", "Accept": "application/json"}
-
     def get_data(url, params=None):
         try:
-            r = requests.get(
+            r = SNIPE_SESSION.get(
                 url,
-                headers=headers,
                 params=params,
                 timeout=SNIPE_TIMEOUT,
                 verify=SNIPE_VERIFY_SSL,
             )
             if r.status_code == 200:
-                d = r.json()
+                d = orjson.loads(r.content)
                 if "id" in d:
                     return [d]
                 return d.get("rows", [])
-            return []
+            if r.status_code == 404:
+                return []
+            return None # Server error: no answer either way
         except:
-            return []
+            return None
+
+    # Fire Tag, Serial and Search at once; keep Tag -> Serial -> Search priority
+    futs = [
+        _SNIPE_POOL.submit(get_data, TAG_URL + term),
+        _SNIPE_POOL.submit(get_data, SERIAL_URL + term),
+        _SNIPE_POOL.submit(get_data, SEARCH_URL, params={"search": term, "limit": 1}),
+    ]
+    results = {}
+    rows = []
+
+    def best_rows(wait_for_pending):
+        # First non-empty result in priority order. When wait_for_pending is
+        # set, stop at a lookup still in flight since it may yet outrank.
+        for i in range(len(futs)):
+            if i not in results:
+                if wait_for_pending:
+                    return None
+                continue
+            if results[i]:
+                return results[i]
+        return []
 
-    # Try Tag -> Serial -> Search
-    rows = get_data(f"{base_api}/hardware/bytag/{term}")
-    if not rows:
-        rows = get_data(f"{base_api}/hardware/byserial/{term}")
-    if not rows:
-        rows = get_data(f"{base_api}/hardware", params={"search": term, "limit": 1})
+    try:
+        for fut in as_completed(futs, timeout=SNIPE_DEADLINE):
+            results[futs.index(fut)] = fut.result()
+            found = best_rows(wait_for_pending=True)
+            if found:
+                rows = found
+                break
+    except FutureTimeout:
+        rows = best_rows(wait_for_pending=False)
+    for fut in futs:
+        fut.cancel()
+
+    # Only a definite miss if every endpoint answered; otherwise report failure
+    if not rows and (len(results) < len(futs) or None in results.values()):
+        return LOOKUP_FAILED
 
     if rows:
         hw = rows[0]
@@ -153,11 +517,44 @@ def lookup_snipe(term):
     return None
 
 
+def _write_xlsx_locked(dest_path):
+    """Converts the CSV to an .xlsx in one streaming pass. Caller holds CSV_LOCK.
+
+    Each row is read, measured for column widths and written out in the same
+    loop; constant_memory flushes it before the next row starts, so no sheet
+    is ever held in memory and the CSV is traversed exactly once.
+    """
+    wb = xlsxwriter.Workbook(str(dest_path), {"constant_memory": True})
+    try:
+        ws = wb.add_worksheet("Scan Data")
+        write = ws.write_string # Keeps scanned text literal (no formulas/URLs)
+        widths = []
+        with open(CURRENT_CSV_P, "r", encoding="utf-8") as f:
+            for row_idx, row in enumerate(csv.reader(f)):
+                if len(row) > len(widths):
+                    widths.extend([0] * (len(row) - len(widths)))
+                for col_idx, value in enumerate(row):
+                    n = len(value)
+                    if n > widths[col_idx]:
+                        widths[col_idx] = n
+                    if value:
+                        write(row_idx, col_idx, value)
+
+        for col_idx, length in enumerate(widths):
+            ws.set_column(col_idx, col_idx, length + 2)
+    finally:
+        wb.close()
+
+
 # ----- Routes -----
+# Compiled once at import; url_for still resolves per request via jinja globals
+_INDEX_TMPL = app.jinja_env.get_template("index.html")
+
+
 @app.route("/")
 def index():
     ensure_csv()
-    return render_template("index.html")
+    return _INDEX_TMPL.render()
 
 
 @app.route("/lookup", methods=["POST"])
@@ -165,7 +562,17 @@ def api_lookup():
     data = request.json or {}
     term = data.get("serial", "").strip() 
 
-    res = lookup_snipe(term)
+    key = term.upper()
+    with LOOKUP_CACHE_LOCK:
+        res = LOOKUP_CACHE.get(key, _MISSING)
+    if res is _MISSING:
+        res = lookup_snipe(term)
+        if res is LOOKUP_FAILED:
+            res = None
+        else:
+            with LOOKUP_CACHE_LOCK:
+                LOOKUP_CACHE[key] = res
+
     if res:
         return jsonify(res)
 
@@ -194,12 +601,17 @@ def api_recent():
     ensure_csv()
     try:
         with CSV_LOCK:
-            with open(CURRENT_CSV, "r", encoding="utf-8") as f:
-                reader = list(csv.reader(f))
-                if len(reader) > 1:
-                    last_rows = reader[1:][-5:]
-                    last_rows.reverse()
-                    return jsonify({"items": last_rows})
+            error = _drain_writes_locked()
+            if error:
+                return jsonify({"items": [], "error": error}), 500
+            # MULTILINE_FIELDS is only known once the batch has been scanned
+            multiline = True
+            if SERIALS_LOADED or not _load_serials_locked():
+                multiline = MULTILINE_FIELDS
+            last_rows = _tail_rows(RECENT_COUNT, multiline)
+            if last_rows:
+                last_rows.reverse()
+                return jsonify({"items": last_rows})
     except:
         pass
     return jsonify({"items": []})
@@ -207,77 +619,97 @@ def api_recent():
 
 @app.route("/finalize", methods=["POST"])
 def api_finalize():
+    global _CSV_PRESENT
     with CSV_LOCK:
-        if not os.path.exists(CURRENT_CSV):
+        error = _drain_writes_locked()
+        if error:
+            return jsonify({"error": error}), 500
+        if not _CSV_PRESENT and not CURRENT_CSV_P.exists():
             return jsonify({"error": "No data to finalize"}), 400
 
         today_str = datetime.now().strftime("%Y%m%d")
         base_name = f"{today_str}-cph-crc"
         filename = f"{base_name}.xlsx"
-        dest_path = os.path.join(COMPLETED_FOLDER, filename)
+        dest_path = COMPLETED_FOLDER_P / filename
 
+        # Claim the name atomically so concurrent workers never pick the same
+        # file; _write_xlsx_locked() overwrites the empty placeholder below.
         counter = 1
-        while os.path.exists(dest_path):
-            filename = f"{base_name}-{counter}.xlsx"
-            dest_path = os.path.join(COMPLETED_FOLDER, filename)
-            counter += 1
+        while True:
+            try:
+                os.close(os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                break
+            except FileExistsError:
+                filename = f"{base_name}-{counter}.xlsx"
+                dest_path = COMPLETED_FOLDER_P / filename
+                counter += 1
 
         try:
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Scan Data"
-
-            with open(CURRENT_CSV, "r", encoding="utf-8") as f:
-                reader = csv.reader(f)
-                for row_idx, row in enumerate(reader, 1):
-                    for col_idx, value in enumerate(row, 1):
-                        ws.cell(row=row_idx, column=col_idx, value=value)
-
-            for column_cells in ws.columns:
-                length = max(len(str(cell.value) or "") for cell in column_cells)
-                ws.column_dimensions[
-                    get_column_letter(column_cells[0].column)
-                ].width = (length + 2)
-
-            wb.save(dest_path)
+            _write_xlsx_locked(dest_path)
 
-            os.remove(CURRENT_CSV)
-            # No need to clear SEEN_SERIALS memory anymore
+            _close_csv_fd_locked()
+            CURRENT_CSV_P.unlink()
+            _CSV_PRESENT = False
+            _invalidate_serials_locked()
 
             return jsonify({"ok": True, "filename": filename})
 
         except Exception as e:
             logging.error(f"Finalize Error: {e}")
+            # Release the claimed name; the batch stays open for a retry
+            dest_path.unlink(missing_ok=True)
             return jsonify({"error": str(e)}), 500
 
 
 @app.route("/reset_batch", methods=["POST"])
 def api_reset_batch():
     """Wipes the current CSV."""
+    global _WRITE_ERROR
     with CSV_LOCK:
-        with open(CURRENT_CSV, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(CSV_HEADERS)
-        # No memory to clear
-        
+        _drain_writes_locked()
+        _close_csv_fd_locked()
+        _write_header_locked()
+        _invalidate_serials_locked()
+        _WRITE_ERROR = None
+
     return jsonify({"ok": True})
 
 
 @app.route("/completed_files", methods=["GET"])
 def api_completed_files():
-    files = []
-    if os.path.exists(COMPLETED_FOLDER):
-        files = [
-            f for f in os.listdir(COMPLETED_FOLDER)
-            if f.endswith(".xlsx") or f.endswith(".csv")
-        ]
-    files.sort(reverse=True)
+    global _FILES_CACHE, _FILES_MTIME
+    try:
+        mtime = COMPLETED_FOLDER_P.stat().st_mtime_ns
+    except FileNotFoundError:
+        return jsonify({"files": []})
+
+    with _FILES_LOCK:
+        if _FILES_CACHE is None or mtime != _FILES_MTIME:
+            with os.scandir(COMPLETED_FOLDER_P) as it:
+                files = [
+                    e.name for e in it
+                    if e.is_file(follow_symlinks=False)
+                    and e.name.endswith((".xlsx", ".csv"))
+                ]
+            files.sort(reverse=True)
+            _FILES_CACHE, _FILES_MTIME = files, mtime
+        files = _FILES_CACHE
     return jsonify({"files": files})
 
 
 @app.route("/download/<path:filename>")
 def download_file(filename):
-    return send_from_directory(COMPLETED_FOLDER, filename, as_attachment=True)
+    if X_ACCEL_PREFIX:
+        path = safe_join(str(COMPLETED_FOLDER_P), filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        resp = app.response_class(mimetype="application/octet-stream")
+        resp.headers["X-Accel-Redirect"] = X_ACCEL_PREFIX.rstrip("/") + "/" + quote(filename)
+        resp.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(filename)}"
+        return resp
+    return send_from_directory(
+        COMPLETED_FOLDER_P, filename, as_attachment=True, max_age=3600
+    )
 
 
 if __name__ == "__main__":
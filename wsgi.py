@@ -0,0 +1,9 @@
+#!/usr/bin/env python3
+# Production entry point. Keep a single worker: duplicate detection and the
+# CSV append descriptor live in process memory, so scale with threads instead.
+# Set WEB_THREADS to the same value as --threads so Snipe-IT lookups get
+# enough pool workers.
+#   WEB_THREADS=8 gunicorn -w 1 -k gthread --threads 8 -b 0.0.0.0:5000 wsgi:app
+from app import app, ensure_csv
+
+ensure_csv()